@@ -1,36 +1,22 @@
-"""esub client.
-
-Usage:
-    esub [options] <key>
-
-Options:
-    --data DATA, -d DATA     Rep a waiting sub with data (- for stdin)
-    --token TOKEN, -t TOKEN  Sub token to use
-    --host HOST, -H HOST     esub server node [default: localhost]
-    --port PORT, -P PORT     esub server port [default: 8090]
-    --psub, -p               sub with a persistent sub
-    --prep, -r               rep with a persistent rep
-    --timeout SECONDS        optional timeout to use
-    --shared, -s             if the psub is shared
-    --debug, -D              enable debugging, show stack traces
-"""
+"""esub client."""
 
 
 import os
 import sys
-import json
 import time
-import asyncio
-import traceback
-import pkg_resources
+import collections
+
+try:
+    from importlib.metadata import version as _pkg_version
+except ImportError:  # python < 3.8
+    import pkg_resources
+    _pkg_version = lambda name: pkg_resources.get_distribution(name).version
 
 import requests
-import websockets
-from docopt import docopt
 
 
-__ALL__ = ["node_ip", "sub", "rep"]
-__version__ = pkg_resources.get_distribution("esub").version
+__ALL__ = ["node_ip", "sub", "rep", "rep_many"]
+__version__ = _pkg_version("esub")
 
 TOKEN = os.environ.get("ESUB_TOKEN")
 PROTOCOL = os.environ.get("ESUB_PROTOCOL", "http")
@@ -38,40 +24,70 @@ WS_PROTOCOL = os.environ.get("ESUB_WEBSOCKET_PROTOCOL", "ws")
 CLUSTER = os.environ.get("ESUB_SERVICE_HOST", "localhost")
 PORT = int(os.environ.get("ESUB_SERVICE_PORT", 8090))
 HEADERS = {
-    "User-Agent": "esub {}".format(
-        pkg_resources.get_distribution("esub").version
-    ),
+    "User-Agent": "esub {}".format(__version__),
+    "Accept-Encoding": "identity",
+    "Connection": "keep-alive",
 }
 RETRIES = int(os.environ.get("ESUB_REQUEST_RETRIES") or 0)
 CONFIRM = bool(os.environ.get("ESUB_CONFIRM_RECEIPT") not in (None, "", "0"))
+CONFIRM_WINDOW = max(1, int(os.environ.get("ESUB_CONFIRM_WINDOW") or 1))
+BATCH_SIZE = max(1, int(os.environ.get("ESUB_BATCH_SIZE") or 1))
 PING_FREQUENCY = int(os.environ.get("ESUB_PING_FREQUENCY") or 60) * 0.9
+POOL_CONNECTIONS = int(os.environ.get("ESUB_POOL_CONNECTIONS") or 16)
+POOL_MAXSIZE = int(os.environ.get("ESUB_POOL_MAXSIZE") or 64)
+POOL_BLOCK = bool(os.environ.get("ESUB_POOL_BLOCK", "1") not in ("", "0"))
+MAX_MESSAGE_SIZE = int(
+    os.environ.get("ESUB_MAX_MESSAGE_SIZE") or 4 * 1024 * 1024
+)
+MAX_QUEUE = int(os.environ.get("ESUB_MAX_QUEUE") or 4)
 
 
 class Cache(object):
-    """Holds the last known node IP (and its session) in memory."""
+    """Holds the last known node IP (and its session) in memory.
+
+    Also holds the runner for our shared event loop and our JSON encoder.
+    """
 
     timestamp = None
     ip_addr = None
     address = None
     session = None
+    run = None
+    encode = None
+
+
+_ADDR_CACHE = {}
+
+
+def _new_session():
+    """Creates a requests session with our pooled, retrying adapter."""
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = requests.adapters.HTTPAdapter(
+        max_retries=RETRIES,
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=POOL_BLOCK,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 def node_addr(node=None):
     """(re)creates a node's session and returns its full address."""
 
-    addr = "{}://{}:{}".format(PROTOCOL, node or CLUSTER, PORT)
+    node = node or CLUSTER
+    addr = _ADDR_CACHE.get((node, PORT))
+    if addr is None:
+        addr = "{}://{}:{}".format(PROTOCOL, node, PORT)
+        _ADDR_CACHE[(node, PORT)] = addr
 
     if Cache.address != addr:
         if Cache.session is not None:
             Cache.session.close()
-        Cache.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(
-            max_retries=RETRIES,
-            pool_connections=10,
-            pool_maxsize=100,
-        )
-        Cache.session.mount("http://", adapter)
-        Cache.session.mount("https://", adapter)
+        Cache.session = _new_session()
 
     Cache.address = addr
     return Cache.address
@@ -87,9 +103,10 @@ def node_ip(cache=10):
         string node IP
     """
 
-    now = time.time()
+    now = time.monotonic()
 
-    if Cache.timestamp and cache > 0 and now - Cache.timestamp < cache:
+    if (Cache.timestamp is not None and cache > 0 and
+            now - Cache.timestamp < cache):
         return Cache.ip_addr
 
     info_url = "{}/info".format(node_addr())
@@ -103,7 +120,7 @@ def node_ip(cache=10):
     return Cache.ip_addr
 
 
-def sub(key, token=None, node=None, timeout=None):
+def sub(key, token=None, node=None, timeout=None, stream=False, out=None):
     """Sub to a key.
 
     Args:
@@ -111,22 +128,35 @@ def sub(key, token=None, node=None, timeout=None):
         token: optional token, fallback to env ESUB_TOKEN
         node: optional specific node, fallback to ESUB_SERVICE_HOST
         timeout: optional timeout
+        stream: boolean to write the reply to `out` as it arrives
+        out: binary file object to stream into, default stdout
 
     Returns:
-        bytes
+        bytes, or None when streaming
     """
 
     token = token or TOKEN
-    node = node_addr(node or CLUSTER)
+    base = node_addr(node)
 
-    if token is None:
-        url = "{}/sub/{}".format(node, key)
-    else:
-        url = "{}/sub/{}?token={}".format(node, key, token)
+    res = Cache.session.get(
+        "".join([base, "/sub/", str(key)]),
+        params={"token": token} if token else None,
+        timeout=timeout,
+        stream=stream,
+        allow_redirects=False,
+    )
 
-    res = Cache.session.get(url, timeout=timeout)
-    res.raise_for_status()
-    return res.content
+    if not stream:
+        res.raise_for_status()
+        return res.content
+
+    # release the pooled connection even when the sub errors
+    with res:
+        res.raise_for_status()
+        out = out or sys.stdout.buffer
+        for chunk in res.iter_content(65536):
+            out.write(chunk)
+    out.flush()
 
 
 def rep(key, data, token=None, node=None, timeout=None, psub=False):
@@ -141,22 +171,99 @@ def rep(key, data, token=None, node=None, timeout=None, psub=False):
         psub: optional boolean to prefer sending to a psub
     """
 
+    base = node_addr(node)
+    _rep(Cache.session, base, key, data, token, timeout, psub)
+
+
+def _rep(session, base, key, data, token, timeout, psub):
+    """POSTs a rep through the given session and node address."""
+
     token = token or TOKEN
 
-    url = "{}/rep/{}{}{}".format(
-        node_addr(node or CLUSTER),
-        key,
-        "?" * int(bool(token or psub)),
-        "&".join(arg for arg in [
-            "token={}".format(token) if token else "",
-            "psub=1" if psub else "",
-        ] if arg),
-    )
+    params = {}
+    if token:
+        params["token"] = token
+    if psub:
+        params["psub"] = 1
 
-    res = Cache.session.post(url, data=data, timeout=timeout)
+    res = session.post(
+        "".join([base, "/rep/", str(key)]),
+        params=params or None,
+        data=data,
+        timeout=timeout,
+        allow_redirects=False,
+    )
     res.raise_for_status()
 
 
+def rep_many(key=None, token=None, node=None, psub=False, func=None,
+             timeout=None, workers=10):
+    """Reply to many subs concurrently over the pooled HTTP session.
+
+    Args:
+        key: sub ID to send all reps to
+        token: auth token to use with all reps
+        node: esub node to connect to
+        psub: boolean if all reps should send to psubs
+        func: function to call per message send, must return an
+              iterator of (key, token, psub, data) for each message.
+              can also be a tuple or a list to send all items as data.
+        timeout: optional POST timeout
+        workers: number of reps to keep in flight at once
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if hasattr(func, "__iter__"):
+        _iter = func
+        func = lambda: iter((key, token, psub, x) for x in _iter)
+
+    # resolve once, so the workers never touch the shared Cache session
+    base = node_addr(node)
+    session = Cache.session
+
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for msg_key, msg_token, msg_psub, msg_data in func():
+            if len(in_flight) >= workers * 2:
+                in_flight.popleft().result()
+            in_flight.append(executor.submit(
+                _rep,
+                session,
+                base,
+                key or msg_key,
+                msg_data,
+                token or msg_token,
+                timeout,
+                psub or msg_psub,
+            ))
+        while in_flight:
+            in_flight.popleft().result()
+
+
+def _run(coro, loop=None):
+    """Runs a coroutine to completion, on a shared event loop by default.
+
+    The shared loop is a uvloop loop when uvloop is installed.
+    """
+
+    if loop is not None:
+        return loop.run_until_complete(coro)
+
+    if Cache.run is None:
+        import asyncio
+        try:
+            from uvloop import new_event_loop
+        except ImportError:
+            new_event_loop = asyncio.new_event_loop
+        try:
+            Cache.run = asyncio.Runner(loop_factory=new_event_loop).run
+        except AttributeError:  # python < 3.11
+            Cache.run = new_event_loop().run_until_complete
+
+    return Cache.run(coro)
+
+
 def psub(key, token=None, node=None, timeout=None, callback=None,
          shared=False, loop=None):
     """Subscribe to a persistent sub.
@@ -166,32 +273,35 @@ def psub(key, token=None, node=None, timeout=None, callback=None,
         token: optional string token, fallback to ESUB_TOKEN
         node: optional specific node, fallback to ESUB_SERVICE_HOST
         timeout: optional timeout
-        callback: function to call with each message received, default print
+        callback: function to call with each message received, default print.
+                  can be a coroutine function to apply backpressure
         shared: boolean if this psub should be shared or exclusive
-        loop: existing event loop to use, or calls asyncio.get_event_loop()
+        loop: existing event loop to use, default a shared module loop
     """
 
+    import asyncio
+    from urllib.parse import urlencode
+
     token = token or TOKEN
-    url = "{}://{}:{}/psub/{}{}{}".format(
-        WS_PROTOCOL,
-        node or CLUSTER,
-        PORT,
-        key,
-        "?" * int(bool(token or timeout or shared)),
-        "&".join(arg for arg in [
-            "token={}".format(token) if token else "",
-            "shared=1" if shared else "",
-            "timeout={}".format(timeout) if timeout else "",
-        ] if arg),
-    )
+
+    params = {}
+    if token:
+        params["token"] = token
+    if shared:
+        params["shared"] = 1
+    if timeout:
+        params["timeout"] = timeout
+
+    url = "{}://{}:{}/psub/{}".format(WS_PROTOCOL, node or CLUSTER, PORT, key)
+    if params:
+        url = "".join([url, "?", urlencode(params)])
 
     if callback is None:
         print("persistent sub to {}".format(url))
         # `callback = print` works as well but doesn't feel nearly as good
         callback = lambda *a, **kw: print(*a, **kw)
 
-    loop = loop or asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait_for(receive(url, callback), timeout))
+    _run(asyncio.wait_for(receive(url, callback), timeout), loop)
 
 
 def prep(key=None, token=None, node=None, psub=False, func=None, timeout=None,
@@ -206,92 +316,240 @@ def prep(key=None, token=None, node=None, psub=False, func=None, timeout=None,
         func: function to call per message send, must return an
               iterator of (key, token, psub, data) for each message.
               can also be a tuple or a list to send all items as data.
+              data is sent as JSON text, so bytes data must be UTF-8.
+              with esub[fast], NaN and infinite floats are sent as null.
         timeout: optional integer seconds to timeout all publish calls with
-        loop: existing event loop to use, or calls asyncio.get_event_loop()
+        loop: existing event loop to use, default a shared module loop
         callback: callback function to run after confirmation. the
                   function must accept two args, the confirmed data,
-                  and the reply data. both strings.
+                  and the reply data. both strings, except the confirmed
+                  data is a list of strings when ESUB_BATCH_SIZE > 1.
+                  runs once ESUB_CONFIRM_WINDOW frames are in flight, so
+                  raising that window above 1 delays confirmations.
     """
 
+    import asyncio
+
     url = "{}://{}:{}/prep".format(WS_PROTOCOL, node or CLUSTER, PORT)
     if hasattr(func, "__iter__"):
         _iter = func
         func = lambda: iter((key, token, psub, x) for x in _iter)
 
-    loop = loop or asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait_for(
+    _run(asyncio.wait_for(
         publish(url, func, sub=key, token=token, psub=psub, callback=callback),
         timeout=timeout,
-    ))
+    ), loop)
 
 
-@asyncio.coroutine
-def keepalive(websocket):
-    """Keep our websocket alive by sending unsolicited PONGs."""
+def _encoder():
+    """Returns a JSON encoder producing str, using orjson when installed.
+
+    orjson accepts the same frames as json, falling back to json for what
+    it can't encode (like ints wider than 64 bits). The one difference is
+    NaN and infinite floats, which orjson sends as null rather than json's
+    non-standard NaN/Infinity.
+    """
+
+    if Cache.encode is None:
+        try:
+            import orjson
+        except ImportError:
+            from json import dumps
+            Cache.encode = dumps
+        else:
+            def _encode(obj):
+                try:
+                    return orjson.dumps(
+                        obj,
+                        option=orjson.OPT_NON_STR_KEYS,
+                    ).decode()
+                except TypeError:
+                    from json import dumps
+                    return dumps(obj)
+
+            Cache.encode = _encode
 
-    while True:
-        yield from asyncio.sleep(PING_FREQUENCY)
-        yield from websocket.pong()
+    return Cache.encode
 
 
 async def publish(url, func, sub=None, token=None, psub=False, callback=None):
-    """Async websocket publish from the specified function."""
+    """Async websocket publish from the specified function.
+
+    When confirming, up to CONFIRM_WINDOW frames are sent ahead of their
+    confirmations rather than waiting a round trip per frame. Receipts are
+    only read once the window is full or func is exhausted, so with a
+    window above the default of 1 the callback for a message from a slow
+    source (like interactive stdin) waits for the window to fill.
+
+    With a BATCH_SIZE above 1, messages are sent in JSON array frames of
+    up to that many messages, which the esub node must support. The node
+    confirms each frame once, so the callback then gets the list of data
+    in the confirmed frame. A batch is only sent once it is full or func
+    is exhausted, so slow sources like interactive stdin hold messages back
+    until BATCH_SIZE of them have arrived.
+    """
+
+    import websockets
+
+    encode = _encoder()
 
     if callback is None:
         callback = lambda x, y: print("{!r}: {}".format(x, y))
 
-    async with websockets.connect(url, max_size=None) as websocket:
-        try:
-            for msg_sub, msg_token, msg_psub, msg_data in func():
+    async with websockets.connect(
+        url,
+        max_size=MAX_MESSAGE_SIZE,
+        max_queue=MAX_QUEUE,
+        ping_interval=PING_FREQUENCY,
+        ping_timeout=PING_FREQUENCY,
+    ) as websocket:
+        # data of each sent but unconfirmed frame, oldest first
+        pending = collections.deque()
+
+        # one frame reused for every message, fixed fields are set once
+        frame = {"key": sub, "token": token, "psub": psub, "data": None}
+        # encoded messages, and their data, waiting to be sent
+        batch = []
+        batch_data = []
+
+        for msg_sub, msg_token, msg_psub, msg_data in func():
+
+            if isinstance(msg_data, bytes):
+                msg_data = msg_data.decode()
+
+            frame["data"] = msg_data
+            if not sub:
+                frame["key"] = msg_sub
+            if not token:
+                frame["token"] = msg_token or TOKEN
+            if not psub:
+                frame["psub"] = msg_psub
+
+            batch.append(encode(frame))
+            batch_data.append(msg_data)
+            if len(batch) < BATCH_SIZE:
+                continue
+
+            await _send_batch(websocket, batch, batch_data, pending)
+
+            if CONFIRM and len(pending) >= CONFIRM_WINDOW:
+                msg = await websocket.recv()
+                callback(pending.popleft(), msg)
 
-                await websocket.send(json.dumps({
-                    "key": sub or msg_sub,
-                    "token": token or msg_token or TOKEN,
-                    "psub": psub or msg_psub,
-                    "data": msg_data,
-                }))
+        if batch:
+            await _send_batch(websocket, batch, batch_data, pending)
 
-                if CONFIRM:
-                    msg = await websocket.recv()
-                    callback(msg_data, msg)
+        while pending:
+            msg = await websocket.recv()
+            callback(pending.popleft(), msg)
 
-        except Exception:
-            websocket.close()
-            raise
+
+async def _send_batch(websocket, batch, batch_data, pending):
+    """Sends and clears the encoded messages, as an array when batching.
+
+    When confirming, the sent data is queued on pending as one entry for
+    the frame: a list of data when batching, otherwise the data itself.
+    """
+
+    if BATCH_SIZE > 1:
+        await websocket.send("".join(["[", ",".join(batch), "]"]))
+        data = list(batch_data)
+    else:
+        await websocket.send(batch[0])
+        data = batch_data[0]
+
+    if CONFIRM:
+        pending.append(data)
+
+    batch.clear()
+    batch_data.clear()
 
 
 async def receive(url, callback):
     """Async websocket receive into the specified callback.
 
-    The callback function should be quick and never error.
+    The callback function should be quick and never error. If it returns
+    a coroutine, that is awaited before reading the next message, so slow
+    consumers apply backpressure instead of growing the receive queue.
+    Buffered incoming data is capped around 4 * MAX_MESSAGE_SIZE * MAX_QUEUE.
     """
 
-    async with websockets.connect(url, max_size=None) as websocket:
-        if not CONFIRM:
-            pinger = asyncio.ensure_future(
-                keepalive(websocket),
-                loop=websocket.loop,
-            )
-        try:
-            while True:
-                message = await websocket.recv()
-                callback(message)
-                if CONFIRM:
-                    await websocket.send("ok")
-        except:
-            if not CONFIRM:
-                pinger.cancel()
-            websocket.close()
-            raise
-
-
-def cli():
-    """Command line entry point."""
-
-    settings = docopt(
-        __doc__,
+    import asyncio
+    import websockets
+
+    async with websockets.connect(
+        url,
+        max_size=MAX_MESSAGE_SIZE,
+        max_queue=MAX_QUEUE,
+        ping_interval=PING_FREQUENCY,
+        ping_timeout=PING_FREQUENCY,
+    ) as websocket:
+        while True:
+            message = await websocket.recv()
+            result = callback(message)
+            if asyncio.iscoroutine(result):
+                await result
+            if CONFIRM:
+                await websocket.send("ok")
+
+
+def _parser():
+    """Builds the command line parser."""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="esub", description=__doc__)
+    parser.add_argument("<key>", help="sub key")
+    parser.add_argument(
+        "--data", "-d", dest="--data", metavar="DATA",
+        help=(
+            "Rep a waiting sub with data (- for stdin, which must be UTF-8 "
+            "lines when used with --prep)"
+        ),
+    )
+    parser.add_argument(
+        "--token", "-t", dest="--token", metavar="TOKEN",
+        help="Sub token to use",
+    )
+    parser.add_argument(
+        "--host", "-H", dest="--host", metavar="HOST", default="localhost",
+        help="esub server node [default: localhost]",
+    )
+    parser.add_argument(
+        "--port", "-P", dest="--port", metavar="PORT", default=8090,
+        type=int, help="esub server port [default: 8090]",
+    )
+    parser.add_argument(
+        "--psub", "-p", dest="--psub", action="store_true",
+        help="sub with a persistent sub",
+    )
+    parser.add_argument(
+        "--prep", "-r", dest="--prep", action="store_true",
+        help="rep with a persistent rep",
+    )
+    parser.add_argument(
+        "--timeout", dest="--timeout", metavar="SECONDS",
+        help="optional timeout to use",
+    )
+    parser.add_argument(
+        "--shared", "-s", dest="--shared", action="store_true",
+        help="if the psub is shared",
+    )
+    parser.add_argument(
+        "--debug", "-D", dest="--debug", action="store_true",
+        help="enable debugging, show stack traces",
+    )
+    parser.add_argument(
+        "--version", action="version",
         version="esub {}".format(__version__),
     )
+    return parser
+
+
+def cli(argv=None):
+    """Command line entry point."""
+
+    settings = vars(_parser().parse_args(argv))
 
     try:
         _cli(settings)
@@ -299,6 +557,7 @@ def cli():
         raise SystemExit("Interrupted")
     except Exception as error:
         if settings["--debug"]:
+            import traceback
             print("".join(traceback.format_exception(*sys.exc_info())))
         else:
             print(error)
@@ -322,20 +581,30 @@ def _cli(settings):
 
         kwargs["psub"] = settings["--psub"]
 
-        if settings["--data"] == "-":
+        if settings["--data"] == "-" and settings["--prep"]:
             def _from_stdin():
-                while True:
+                for number, line in enumerate(sys.stdin.buffer, 1):
+                    if line.endswith(b"\n"):
+                        line = line[:-1]
                     try:
-                        yield (
-                            settings["<key>"],
-                            settings["--token"],
-                            settings["--psub"],
-                            input(),
+                        line = line.decode("utf-8")
+                    except UnicodeDecodeError as error:
+                        raise SystemExit(
+                            "stdin line {} is not UTF-8: {}".format(
+                                number,
+                                error,
+                            )
                         )
-                    except (KeyboardInterrupt, EOFError):
-                        raise SystemExit
+                    yield (
+                        settings["<key>"],
+                        settings["--token"],
+                        settings["--psub"],
+                        line,
+                    )
 
             data = _from_stdin
+        elif settings["--data"] == "-":
+            data = sys.stdin.buffer.read()
         elif settings["--prep"]:
             data = settings["--data"].split(",")
         else:
@@ -351,7 +620,7 @@ def _cli(settings):
         psub(settings["<key>"], **kwargs)
 
     else:
-        print(sub(settings["<key>"], **kwargs))
+        sub(settings["<key>"], stream=True, out=sys.stdout.buffer, **kwargs)
 
 
 if __name__ == "__main__":
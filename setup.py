@@ -24,5 +24,6 @@ setup(
     long_description=setuphelpers.long_description(),
     cmdclass=setuphelpers.test_command(cover="esub", pdb=True),
     tests_require=["pytest", "pytest-cov", "mock"],
-    install_requires=["requests", "websockets", "docopt"],
+    install_requires=["requests", "websockets"],
+    extras_require={"fast": ["orjson", "uvloop"]},
 )
@@ -0,0 +1,558 @@
+"""Tests for the esub client library."""
+
+
+import io
+import json
+import asyncio
+
+import mock
+import pytest
+
+import esub
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    """Start every test from a fresh process' module state."""
+
+    monkeypatch.setattr(esub.Cache, "session", None)
+    monkeypatch.setattr(esub.Cache, "address", None)
+    monkeypatch.setattr(esub, "_ADDR_CACHE", {})
+    monkeypatch.setattr(esub.Cache, "encode", None)
+    monkeypatch.setattr(esub.Cache, "timestamp", None)
+    monkeypatch.setattr(esub.Cache, "ip_addr", None)
+    monkeypatch.setattr(esub.Cache, "run", None)
+
+    yield
+
+    if esub.Cache.run is not None:
+        # the runner, or pre 3.11 the loop, that this test created
+        esub.Cache.run.__self__.close()
+
+
+class FakeWebsocket(object):
+    """Records sent frames and answers every recv with a receipt."""
+
+    def __init__(self, received=None):
+        self.sent = []
+        self.received = list(received or [])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def recv(self):
+        if self.received:
+            return self.received.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def websocket():
+    """Patches websockets.connect to hand out a FakeWebsocket."""
+
+    fake = FakeWebsocket()
+    with mock.patch("websockets.connect", return_value=fake):
+        yield fake
+
+
+@pytest.fixture
+def session():
+    """Patches session creation to hand out mock sessions."""
+
+    with mock.patch.object(esub, "_new_session") as patched:
+        patched.side_effect = lambda: mock.MagicMock()
+        yield patched
+
+
+def test_sub_creates_session(session):
+    """A first sub call needs to create the session before using it."""
+
+    assert esub.sub("key", token="secret", node="host") is \
+        esub.Cache.session.get.return_value.content
+
+    esub.Cache.session.get.assert_called_once_with(
+        "http://host:{}/sub/key".format(esub.PORT),
+        params={"token": "secret"},
+        timeout=None,
+        stream=False,
+        allow_redirects=False,
+    )
+
+
+def test_rep_creates_session(session):
+    """A first rep call needs to create the session before using it."""
+
+    esub.rep("key", b"data", node="host", psub=True)
+
+    esub.Cache.session.post.assert_called_once_with(
+        "http://host:{}/rep/key".format(esub.PORT),
+        params={"psub": 1},
+        data=b"data",
+        timeout=None,
+        allow_redirects=False,
+    )
+
+
+def test_non_str_keys(session):
+    """Keys are formatted into the path, as they always have been."""
+
+    esub.sub(123, node="host")
+    esub.rep(456, b"data", node="host")
+
+    url = "http://host:{}/{}".format
+    assert esub.Cache.session.get.call_args[0][0] == url(esub.PORT, "sub/123")
+    assert esub.Cache.session.post.call_args[0][0] == url(esub.PORT, "rep/456")
+
+
+def test_rep_uses_new_node_session(session):
+    """Changing nodes should send through the new session, not the old."""
+
+    esub.rep("key", b"data", node="one")
+    old_session = esub.Cache.session
+
+    esub.rep("key", b"data", node="two")
+
+    old_session.close.assert_called_once_with()
+    assert esub.Cache.session is not old_session
+    assert esub.Cache.session.post.call_args[0][0].startswith("http://two:")
+
+
+def test_rep_many(session):
+    """rep_many sends every item, through the session it started with."""
+
+    esub.rep_many("key", token="secret", func=[b"a", b"b", b"c"], workers=2)
+
+    posts = esub.Cache.session.post.call_args_list
+    assert sorted(call[1]["data"] for call in posts) == [b"a", b"b", b"c"]
+    for call in posts:
+        assert call[0][0] == "http://{}:{}/rep/key".format(
+            esub.CLUSTER,
+            esub.PORT,
+        )
+        assert call[1]["params"] == {"token": "secret"}
+
+
+def test_rep_many_ignores_node_changes(session):
+    """Workers keep their session even if the Cache moves to a new node."""
+
+    started = []
+
+    def _messages():
+        started.append(esub.Cache.session)
+        yield "key", None, False, b"a"
+        esub.node_addr("elsewhere")
+        yield "key", None, False, b"b"
+
+    esub.rep_many(func=_messages, node="here")
+
+    assert esub.Cache.session is not started[0]
+    assert started[0].post.call_count == 2
+    assert esub.Cache.session.post.call_count == 0
+
+
+def test_rep_many_raises(session):
+    """Errors from any worker are raised to the caller."""
+
+    def _new_session():
+        failing = mock.Mock()
+        failing.post.return_value.raise_for_status.side_effect = ValueError
+        return failing
+
+    session.side_effect = _new_session
+
+    with pytest.raises(ValueError):
+        esub.rep_many("key", func=[b"a"])
+
+
+def test_prep_sends_text_frames(websocket):
+    """prep frames are JSON text, and the encoder is only resolved on use."""
+
+    assert esub.Cache.encode is None
+
+    esub.prep("key", token="secret", func=[b"a", "b"], timeout=1)
+
+    assert all(isinstance(frame, str) for frame in websocket.sent)
+    assert [json.loads(frame) for frame in websocket.sent] == [
+        {"key": "key", "token": "secret", "psub": False, "data": "a"},
+        {"key": "key", "token": "secret", "psub": False, "data": "b"},
+    ]
+
+
+@pytest.mark.parametrize("data", [
+    "text",
+    {1: "non str key", "nested": [1.5, None, True]},
+    2 ** 70,
+    {"wide": -(2 ** 80)},
+])
+def test_encoders_agree(data, monkeypatch):
+    """orjson and json encode the same frames to the same JSON."""
+
+    pytest.importorskip("orjson")
+    frame = {"key": "key", "token": None, "psub": False, "data": data}
+
+    fast = esub._encoder()(frame)
+    monkeypatch.setattr(esub.Cache, "encode", None)
+    with mock.patch.dict("sys.modules", {"orjson": None}):
+        slow = esub._encoder()(frame)
+
+    assert isinstance(fast, str)
+    assert json.loads(fast) == json.loads(slow)
+
+
+def test_psub_sends_text_receipts(websocket, monkeypatch):
+    """Confirmed psub messages are acknowledged with a Text "ok" frame."""
+
+    class Done(Exception):
+        pass
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+    websocket.received = ["one", "two"]
+    received = []
+
+    def _callback(message):
+        received.append(message)
+        if len(received) == 2:
+            raise Done
+
+    with pytest.raises(Done):
+        esub.psub("key", callback=_callback)
+
+    assert received == ["one", "two"]
+    assert websocket.sent == ["ok"]
+
+
+def test_cli_prep_stdin_stops_on_bad_lines(websocket, monkeypatch):
+    """A non UTF-8 stdin line fails the run, naming the line."""
+
+    stdin = mock.Mock()
+    stdin.buffer = io.BytesIO(b"one\ntw\xc3\xb6\r\n\xff\nnever sent\n")
+    monkeypatch.setattr(esub.sys, "stdin", stdin)
+
+    with pytest.raises(SystemExit) as error:
+        esub.cli(["--prep", "--data", "-", "key"])
+
+    assert "stdin line 3" in str(error.value)
+    assert [json.loads(frame)["data"] for frame in websocket.sent] == [
+        "one",
+        "tw\u00f6\r",
+    ]
+
+
+def test_prep_without_confirm_never_waits(websocket, monkeypatch):
+    """Without receipts, publish must not wait on the socket at all."""
+
+    monkeypatch.setattr(esub, "CONFIRM", False)
+    monkeypatch.setattr(esub, "BATCH_SIZE", 2)
+    websocket.recv = mock.Mock(side_effect=AssertionError("recv called"))
+
+    esub.prep("key", func=["a", "b", "c"], timeout=1)
+
+    assert len(websocket.sent) == 2
+
+
+def test_prep_batches_confirm_per_frame(websocket, monkeypatch):
+    """Batched frames are JSON arrays, each confirmed once as a list."""
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+    monkeypatch.setattr(esub, "CONFIRM_WINDOW", 1)
+    monkeypatch.setattr(esub, "BATCH_SIZE", 2)
+    confirmed = []
+
+    esub.prep(
+        "key",
+        func=["a", "b", "c"],
+        timeout=1,
+        callback=lambda data, reply: confirmed.append((data, reply)),
+    )
+
+    assert [[msg["data"] for msg in json.loads(frame)]
+            for frame in websocket.sent] == [["a", "b"], ["c"]]
+    assert confirmed == [(["a", "b"], "ok"), (["c"], "ok")]
+
+
+def test_sub_streams_to_out(session):
+    """Streaming subs write each chunk to the given file object."""
+
+    out = io.BytesIO()
+    esub.node_addr()
+    esub.Cache.session.get.return_value.iter_content.return_value = [
+        b"first ",
+        b"second",
+    ]
+
+    assert esub.sub("key", stream=True, out=out) is None
+
+    assert out.getvalue() == b"first second"
+    esub.Cache.session.get.return_value.iter_content.assert_called_once_with(
+        65536
+    )
+
+
+def test_sub_stream_error_releases_connection(session):
+    """A failed streaming sub still closes its response."""
+
+    esub.node_addr()
+    response = esub.Cache.session.get.return_value
+    response.raise_for_status.side_effect = ValueError
+
+    with pytest.raises(ValueError):
+        esub.sub("key", stream=True, out=io.BytesIO())
+
+    response.__exit__.assert_called_once()
+
+
+def test_prep_confirm_window(websocket, monkeypatch):
+    """Up to CONFIRM_WINDOW frames are sent before waiting on receipts."""
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+    monkeypatch.setattr(esub, "CONFIRM_WINDOW", 3)
+    events = []
+
+    async def _recv():
+        events.append("recv")
+        return "ok"
+
+    async def _send(message):
+        events.append("send")
+
+    websocket.recv = _recv
+    websocket.send = _send
+
+    esub.prep("key", func=["a", "b", "c", "d"], timeout=1,
+              callback=lambda data, reply: None)
+
+    assert events == ["send"] * 3 + ["recv", "send", "recv"] + ["recv"] * 2
+
+
+def test_prep_confirms_each_frame_by_default(websocket, monkeypatch):
+    """By default every frame is confirmed before the next is sent."""
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+    events = []
+
+    async def _recv():
+        events.append("recv")
+        return "ok"
+
+    async def _send(message):
+        events.append("send")
+
+    websocket.recv = _recv
+    websocket.send = _send
+
+    esub.prep("key", func=["a", "b"], timeout=1,
+              callback=lambda data, reply: events.append(data))
+
+    assert esub.CONFIRM_WINDOW == 1
+    assert events == ["send", "recv", "a", "send", "recv", "b"]
+
+
+def test_psub_url(websocket):
+    """psub encodes its query, and leaves it off when there is none."""
+
+    class Closed(Exception):
+        pass
+
+    websocket.recv = mock.Mock(side_effect=Closed)
+
+    connect = mock.patch("websockets.connect", return_value=websocket)
+    with connect as patched:
+        for kwargs in ({}, {"token": "a b", "shared": True, "timeout": 5}):
+            with pytest.raises(Closed):
+                esub.psub("key", node="host", callback=print, **kwargs)
+
+    base = "ws://host:{}/psub/key".format(esub.PORT)
+    assert [call[0][0] for call in patched.call_args_list] == [
+        base,
+        base + "?token=a+b&shared=1&timeout=5",
+    ]
+
+
+def test_parser_matches_docopt_settings():
+    """The argparse settings keep the docopt names _cli relies on."""
+
+    settings = vars(esub._parser().parse_args(
+        ["-d", "a,b", "-t", "secret", "-P", "9000", "-r", "key"],
+    ))
+
+    assert settings == {
+        "<key>": "key",
+        "--data": "a,b",
+        "--token": "secret",
+        "--host": "localhost",
+        "--port": 9000,
+        "--psub": False,
+        "--prep": True,
+        "--timeout": None,
+        "--shared": False,
+        "--debug": False,
+    }
+
+
+def test_node_ip_cache_uses_monotonic_clock(session):
+    """Wall clock jumps don't affect how long node_ip caches for."""
+
+    esub.node_addr()
+    esub.Cache.session.get.return_value.json.return_value = {"ip": "1.2.3.4"}
+
+    with mock.patch.object(esub.time, "monotonic", return_value=100.0):
+        assert esub.node_ip() == "1.2.3.4"
+
+    with mock.patch.object(esub.time, "monotonic", return_value=105.0):
+        with mock.patch.object(esub.time, "time", return_value=0):
+            assert esub.node_ip() == "1.2.3.4"
+
+    assert esub.Cache.session.get.call_count == 1
+
+    with mock.patch.object(esub.time, "monotonic", return_value=111.0):
+        esub.node_ip()
+
+    assert esub.Cache.session.get.call_count == 2
+
+
+def test_prep_per_message_fields(websocket, monkeypatch):
+    """Reusing the frame keeps per-message key, token and psub overrides."""
+
+    monkeypatch.setattr(esub, "TOKEN", "default")
+
+    def _messages():
+        yield "one", "first", True, "a"
+        yield "two", None, False, "b"
+
+    esub.prep(func=_messages, timeout=1)
+
+    assert [json.loads(frame) for frame in websocket.sent] == [
+        {"key": "one", "token": "first", "psub": True, "data": "a"},
+        {"key": "two", "token": "default", "psub": False, "data": "b"},
+    ]
+
+
+def test_new_session_sends_headers():
+    """Sessions carry our headers and the pooled adapter."""
+
+    session = esub._new_session()
+
+    for header, value in esub.HEADERS.items():
+        assert session.headers[header] == value
+    adapter = session.get_adapter("http://localhost")
+    assert adapter._pool_maxsize == esub.POOL_MAXSIZE
+    assert adapter._pool_block == esub.POOL_BLOCK
+
+
+def test_receive_awaits_async_callbacks(websocket, monkeypatch):
+    """An async callback finishes before the receipt or the next recv."""
+
+    class Done(Exception):
+        pass
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+    events = []
+    messages = ["one", "two"]
+
+    async def _recv():
+        if not messages:
+            raise Done
+        events.append("recv")
+        return messages.pop(0)
+
+    async def _send(message):
+        events.append(message)
+
+    async def _callback(message):
+        events.append("start " + message)
+        await asyncio.sleep(0)
+        events.append("end " + message)
+
+    websocket.recv = _recv
+    websocket.send = _send
+
+    with pytest.raises(Done):
+        esub.psub("key", callback=_callback)
+
+    assert events == [
+        "recv", "start one", "end one", "ok",
+        "recv", "start two", "end two", "ok",
+    ]
+
+
+def test_websocket_limits(websocket):
+    """Both websocket paths connect with the bounded size and queue."""
+
+    websocket.recv = mock.Mock(side_effect=ValueError)
+
+    with mock.patch("websockets.connect", return_value=websocket) as patched:
+        esub.prep("key", func=["a"], timeout=1)
+        with pytest.raises(ValueError):
+            esub.psub("key", callback=print)
+
+    for call in patched.call_args_list:
+        assert call[1]["max_size"] == esub.MAX_MESSAGE_SIZE
+        assert call[1]["max_queue"] == esub.MAX_QUEUE
+    assert patched.call_count == 2
+
+
+def test_prep_reuses_event_loop(websocket):
+    """Consecutive preps run on the same shared loop."""
+
+    loops = []
+
+    async def _send(message):
+        loops.append(asyncio.get_running_loop())
+
+    websocket.send = _send
+
+    esub.prep("key", func=["a"], timeout=1)
+    run = esub.Cache.run
+    esub.prep("key", func=["b"], timeout=1)
+
+    assert esub.Cache.run is run
+    assert len(loops) == 2 and loops[0] is loops[1]
+
+
+def test_prep_uses_given_loop(websocket):
+    """A caller supplied loop is used instead of the shared one."""
+
+    loop = asyncio.new_event_loop()
+    spy = mock.patch.object(
+        loop,
+        "run_until_complete",
+        wraps=loop.run_until_complete,
+    )
+
+    try:
+        with spy as run_until_complete:
+            esub.prep("key", func=["a"], loop=loop)
+    finally:
+        loop.close()
+
+    run_until_complete.assert_called_once()
+    assert esub.Cache.run is None
+    assert len(websocket.sent) == 1
+
+
+def test_shared_loop_survives_timeouts(websocket, monkeypatch):
+    """A timed out prep leaves the shared loop usable."""
+
+    monkeypatch.setattr(esub, "CONFIRM", True)
+
+    async def _never():
+        await asyncio.sleep(60)
+
+    websocket.recv = _never
+
+    with pytest.raises(asyncio.TimeoutError):
+        esub.prep("key", func=["a"], timeout=0.01)
+
+    monkeypatch.setattr(esub, "CONFIRM", False)
+    esub.prep("key", func=["b"], timeout=1)
+
+    assert [json.loads(frame)["data"] for frame in websocket.sent] == [
+        "a",
+        "b",
+    ]